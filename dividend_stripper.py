@@ -8,9 +8,14 @@
 # ---------------------------------------------------------------------------- #
 
 import sys
+import os
+import getopt
 import requests
 import calendar
 import time
+import threading
+import Queue
+import itertools
 
 # BeautifulSoup HTML parsing library
 from bs4 import BeautifulSoup, SoupStrainer
@@ -24,6 +29,9 @@ from http.requests.proxy.requestProxy import RequestProxy
 # Contain all data in a MySQL database
 import MySQLdb
 
+# Ticker universe maintained by the exchange scraper
+from nasdaq_scraper import TickerUniverse, UniverseDelta, nasdaq_file, peak_rss_kb
+
 # Database login information.  Change this to fit your own parameters
 DB_HOST="127.0.0.1"
 DB_USER="root"
@@ -66,6 +74,21 @@ days_per_month = {'1' : '31',
 # The name to give the upcoming Ex-dividend dates file
 UPCOMING_EX_DATES = "./upcoming_ex_dates.txt"
 
+# Completed tickers are journaled here while a scan is running so that a crashed run
+# can be resumed.  At the end of the run it gets compacted into the results file.
+SCAN_JOURNAL = "./dividend_scan_journal.txt"
+SCAN_RESULTS = "./dividend_scan_results.txt"
+
+# Number of tickers scanned at the same time
+PIPELINE_WORKERS = 4
+
+# Most items that can be waiting between two pipeline stages.  A full queue blocks the
+# stage feeding it, so memory use doesn't depend on how many tickers are being scanned.
+PIPELINE_QUEUE_SIZE = 16
+
+# Seconds the store stage waits on the result queue before checking for Ctrl-C again
+PIPELINE_POLL_INTERVAL = 0.5
+
 # Function to account for leap years
 def get_days_per_month(month, year):
     if month != '2' or (month == '2' and not calendar.isleap(int(year))):
@@ -119,22 +142,18 @@ def update_ex_div_dates(req_proxy):
 
         iterator = iterator + 1
 
-    ex_data_per_date = []
-
-    for set_of_stocks in upcoming_ex_soup.find_all('tbody'):
-        ex_data_per_date.append([(stock.find_all('td')[0].text, stock.find_all('td')[1].text, stock.find_all('td')[2].text,\
-            stock.find_all('td')[3].text, stock.find_all('td')[4].text, stock.find_all('td')[5].text)\
-            for stock in set_of_stocks.find_all('tr')])
-
     # Open the file to write the dividend data to
     dividend_file = open(UPCOMING_EX_DATES, "w+")
 
+    # Write each stock out as soon as it is parsed rather than collecting every day first
     iterator = 0
-    for day in ex_data_per_date:
+    for set_of_stocks in upcoming_ex_soup.find_all('tbody'):
         dividend_file.write("Date: " + ex_dates[iterator] + "\n")
 
-        for stock in day:
-            dividend_file.write("%s, %s, %s, %s, %s, %s\n" % (stock[0], stock[1], stock[2], stock[3], stock[4], stock[5]))
+        for stock in set_of_stocks.find_all('tr'):
+            cells = stock.find_all('td')
+            dividend_file.write("%s, %s, %s, %s, %s, %s\n" % (cells[0].text, cells[1].text, cells[2].text,
+                cells[3].text, cells[4].text, cells[5].text))
 
         iterator = iterator + 1
 
@@ -189,235 +208,616 @@ class dividend_stripper:
     def __init__(self):
         self.stock_database = stock_database()
 
-    def update_ex_div_dates(req_proxy):
-        save_stdout = sys.stdout
-        dev_null = open("/dev/null", "w")
-        sys.stdout = dev_null
 
-        upcoming_ex_data = None
-        while upcoming_ex_data is None:
-            upcoming_ex_data = req_proxy.generate_proxied_request("http://dividata.com/dividates")
+class in_flight_fetch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
-        dev_null.close()
-        sys.stdout = save_stdout
 
-        # Parse result from requests.get()
-        upcoming_ex_soup = BeautifulSoup(upcoming_ex_data.text, 'html5lib')
+class request_coalescer:
+    def __init__(self):
+        # Single-flight layer for upstream fetches.  Concurrent requests for the same key
+        # wait on the one request that is already in flight and share its result.
+        # Nothing is kept once a fetch finishes.  The scan drops duplicate tickers before
+        # they ever reach a worker and every key includes the ticker, so a finished key
+        # is never asked for again and holding on to pages would only cost memory.
+        self.lock = threading.Lock()
+
+        # key -> in_flight_fetch
+        self.in_flight = {}
+
+        # Instrumentation for the end of run report
+        self.upstream_calls = 0
+        self.coalesced_calls = 0
+
+    def fetch(self, key, fetch_function):
+        # Returns fetch_function()'s result, calling it only if no other caller is already
+        # fetching key.  Exceptions raised by the fetch are passed along to every caller
+        # that was waiting on it.
+        with self.lock:
+            call = self.in_flight.get(key)
+
+            if call is not None:
+                self.coalesced_calls = self.coalesced_calls + 1
+                leader = False
+            else:
+                call = in_flight_fetch()
+                self.in_flight[key] = call
+                self.upstream_calls = self.upstream_calls + 1
+                leader = True
 
-        # The day titles are stored in thead sections.  All of the odd titles are useless.
-        # Filter them out
-        ex_dates = []
-        iterator = 0
-        for date in upcoming_ex_soup.find_all('thead'):
-            # Is the index even?  If it is, save the date
-            if iterator % 2 == 0:
-                ex_dates.append(date.text)
+        if leader is False:
+            call.done.wait()
 
-            iterator = iterator + 1
+            if call.error is not None:
+                raise call.error
 
-        ex_data_per_date = []
+            return call.result
 
-        for set_of_stocks in upcoming_ex_soup.find_all('tbody'):
-            ex_data_per_date.append([(stock.find_all('td')[0].text, stock.find_all('td')[1].text, stock.find_all('td')[2].text,\
-                stock.find_all('td')[3].text, stock.find_all('td')[4].text, stock.find_all('td')[5].text)\
-                for stock in set_of_stocks.find_all('tr')])
+        # However the fetch ends (KeyboardInterrupt and SystemExit included), the key has
+        # to come out of in_flight and the waiters have to be woken up, or they'll block
+        # forever.
+        try:
+            call.result = fetch_function()
+        except Exception as e:
+            call.error = e
+        except BaseException:
+            call.error = RuntimeError("Fetch of %s was interrupted" % str(key))
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
 
-        # Open the file to write the dividend data to
-        dividend_file = open(UPCOMING_EX_DATES, "w+")
+            call.done.set()
 
-        iterator = 0
-        for day in ex_data_per_date:
-            dividend_file.write("Date: " + ex_dates[iterator] + "\n")
+        if call.error is not None:
+            raise call.error
 
-            for stock in day:
-                dividend_file.write("%s, %s, %s, %s, %s, %s\n" % (stock[0], stock[1], stock[2], stock[3], stock[4], stock[5]))
+        return call.result
 
-            iterator = iterator + 1
+    def report(self):
+        print "Upstream requests: %s" % (self.upstream_calls)
+        print "Coalesced requests: %s (duplicate tickers are dropped before the scan)" % (self.coalesced_calls)
 
-        dividend_file.close()
 
-class stock_database:
-    def __init__(self):
+# Every fetch in the scan goes through this
+fetch_coalescer = request_coalescer()
 
 
+class quiet_stdout:
+    # Points stdout at /dev/null for the duration of a with block.  This is only for
+    # the proxy library's chatter.  Scan workers run concurrently, so stdout is only
+    # swapped out by the first worker in and restored by the last one out, and while
+    # it's swapped a plain print from any thread goes nowhere.  Anything we want to
+    # see during a scan has to go through scan_print() instead.
+    lock = threading.Lock()
+    depth = 0
+    save_stdout = None
+    dev_null = None
 
+    def __enter__(self):
+        with quiet_stdout.lock:
+            if quiet_stdout.depth == 0:
+                quiet_stdout.save_stdout = sys.stdout
+                quiet_stdout.dev_null = open("/dev/null", "w")
+                sys.stdout = quiet_stdout.dev_null
 
-def main(argc, argv):
+            quiet_stdout.depth = quiet_stdout.depth + 1
 
-    div_stripper = dividend_stripper()
+    def __exit__(self, exc_type, exc_value, traceback):
+        with quiet_stdout.lock:
+            quiet_stdout.depth = quiet_stdout.depth - 1
 
+            if quiet_stdout.depth == 0:
+                sys.stdout = quiet_stdout.save_stdout
+                quiet_stdout.dev_null.close()
 
+        return False
 
 
-    # Set up proxy generator in order to prevent ipbans
-    # Redirect stdout so that the proxy function doesn't print annoying functions to the screen
-    save_stdout = sys.stdout
-    dev_null = open("/dev/null", "w")
-    sys.stdout = dev_null
+# Serializes scan output so that lines from different workers don't interleave
+scan_output_lock = threading.Lock()
 
-    req_proxy = RequestProxy()
 
-    dev_null.close()
-    sys.stdout = save_stdout
+def scan_print(text = ""):
+    # Writes to the real stdout, which quiet_stdout never touches
+    with scan_output_lock:
+        sys.__stdout__.write(text + "\n")
+        sys.__stdout__.flush()
 
-    # Can eventually read this in from a file
-    #tickers_to_test = ['XOM', 'BMY', 'EAT', 'KO', 'CRF', 'GLDI', 'GE']
-    #tickers_to_test = ['GILD', 'AAT', 'AMOT', 'BBBY']
-    #tickers_to_test = ['AIMC', 'ALOG', 'AME', 'ARII']
-    tickers_to_test = ['ARII']# 'DIA', 'XOM', 'GE']
 
-    update_ex_div_dates(req_proxy)
+def new_request_proxy():
+    # Set up proxy generator in order to prevent ipbans.  The library isn't thread
+    # safe, so every scan worker builds its own.
+    with quiet_stdout():
+        return RequestProxy()
 
-    # Read in the tickers to check from the dividend file
-    dividend_file = open(UPCOMING_EX_DATES, "r")
 
-    for line in dividend_file.readlines():
-        tickers_to_test.append(line.split(',')[0].strip())
+def fetch_proxied_page(req_proxy, url):
+    # The proxy library hands back None when a proxy fails.  Keep trying until one works.
+    page_data = None
 
+    while page_data is None:
+        page_data = req_proxy.generate_proxied_request(url)
 
-    # Store all data in a MySQL database.
-    # Create a table for each stock.  Start by deleting any that are already there.
-    for ticker in tickers_to_test:
-        pass
+    return page_data
 
 
-    sys.exit(1)
+def fetch_ex_dividend_history(req_proxy, ticker):
+    # Returns a generator of (date, amount) tuples for the last five years of ex-dividend
+    # dates or None if the page could not be fetched.
+    ex_dividend_data = None
+    ex_dividend_url = "http://dividata.com/stock/%s/dividend" % ticker
 
+    # The requests proxy library sometimes throws some weird exceptions.  If that happens, break out of
+    # the loop and don't do anything.
+    try:
+        with quiet_stdout():
+            ex_dividend_data = fetch_coalescer.fetch(ex_dividend_url,
+                lambda: fetch_proxied_page(req_proxy, ex_dividend_url))
+    except Exception as e:
+        ex_dividend_data = None
 
+    if ex_dividend_data is None:
+        return None
 
+    # Parse it using BeautifulSoup
+    ex_dividend_soup = BeautifulSoup(ex_dividend_data.text, 'html5lib');
 
+    return iter_ex_dividend_history(ex_dividend_soup)
 
 
+def iter_ex_dividend_history(ex_dividend_soup):
+    # Extract the dates and dividend amounts for each stock.
+    ex_dividend_soup = ex_dividend_soup.find_all("tr")
 
-    for ticker in tickers_to_test:
+    # The first element in the list is useless, get rid of it
+    # Figure out a better way to deal with this
+    first = True
 
-        print "Ticker: %s" % ticker
+    # Make a nice data structure containing the dates
+    for ex_div in ex_dividend_soup:
+        if first == True:
+            first = False
+            continue
 
-        # http://dividata.com/stock/XOM/dividend
+        # dividata has the odd row with a missing cell or a date/amount that doesn't
+        # parse.  Skip just that row rather than the whole ticker.
+        try:
+            div_element = ex_div.find_all('td')
 
-        # Note: Eventually, replace the requests.get with the proxy version.  I don't want to get ipbanned
+            date = div_element[0].text.replace(",", "")
+            date = date.lower().split(" ")
 
-        # Get the data for the ticker
-        save_stdout = sys.stdout
-        dev_null = open("/dev/null", "w")
-        sys.stdout = dev_null
+            year = int(date[2])
+            date = "%s-%s-%s" % (date[2], MONTHS[date[0]], date[1])
 
-        print "Starting data collection"
-        ex_dividend_data = None
+            amount = float(div_element[1].text.replace("$", ""))
+        except (IndexError, KeyError, ValueError) as e:
+            scan_print("[ERROR]: Skipping malformed dividend row: %s" % str(e))
+            continue
 
-        # The requests proxy library sometimes throws some weird exceptions.  If that happens, break out of
-        # the loop and don't do anything.
-        skip = False
-        while ex_dividend_data is None:
-            try:
-                ex_dividend_data = req_proxy.generate_proxied_request("http://dividata.com/stock/%s/dividend" % ticker)
-            except Exception as e:
-                skip = True
-                break
+        # If the year is greater than 5 years ago, break.  Yahoo finance
+        # doesn't have history going back that far
+        if (CURRENT_YEAR - 5) > year:
+            break
+
+        yield (date, amount)
+
+
+def fetch_ex_dividend_prices(ticker, ex_dividend_history):
+    # Get share data for each ex-dividend date.  Get the price on that day
+    # and the price the day before.  Prices are yielded as they come in.
+    ticker_share = fetch_coalescer.fetch(('share', ticker), lambda: Share(ticker))
+
+    for ex_div in ex_dividend_history:
+        start_date = subtract_one_day(ex_div[0])
+        end_date = ex_div[0]
+
+        # Yahoo occasionally just fails on a date.  Skip it rather than stopping the run.
+        try:
+            historical_prices = fetch_coalescer.fetch((ticker, start_date, end_date),
+                lambda: ticker_share.get_historical(start_date, end_date))
+        except Exception as e:
+            scan_print("[ERROR]: Could not get prices for %s on %s: %s" % (ticker, ex_div[0], str(e)))
+            historical_prices = None
 
-        # If something went wrong collecting data, just go on to the next ticker
-        if skip is True:
+        if historical_prices is not None:
+            yield (historical_prices, ex_div[1])
+
+        time.sleep(0.1)
+
+
+def evaluate_ex_dividend_prices(ex_dividend_stock_prices):
+    successes = 0
+    failures = 0
+
+    # Now, see if the stock price actually recovered the day after the dividend got paid out
+    for dividend_event in ex_dividend_stock_prices:
+
+        # Some of the dividend_events have a length of only 1.  Figure out why this is later on
+        if len(dividend_event[0]) != 2:
             continue
 
-            print "Data: %s" % ex_dividend_data
-        print "Finished data collection"
+        try:
+            dividend_payout = float(dividend_event[1])
+            pre_dividend_close = float(dividend_event[0][1]['Close'])
+            post_dividend_open = float(dividend_event[0][1]['Open'])
+            post_dividend_h = float(dividend_event[0][1]['High'])
+            post_dividend_high = float(dividend_event[0][0]['Close'])
 
-        dev_null.close()
-        sys.stdout = save_stdout
 
-        # Parse it using BeautifulSoup
-        ex_dividend_soup = BeautifulSoup(ex_dividend_data.text, 'html5lib');
+            if post_dividend_open == post_dividend_h:
+                post_dividend_h = 99999.00
 
-        # Extract the dates and dividend amounts for each stock.
-        ex_dividend_history = []
-        ex_dividend_soup = ex_dividend_soup.find_all("tr")
+        except Exception as e:
+            scan_print("[ERROR]: Malformed price data: %s" % str(e))
+            continue
 
-        # The first element in the list is useless, get rid of it
-        # Figure out a better way to deal with this
-        first = True
+        # One write so another worker's output can't land in the middle of it
+        scan_print("Divident Payout: %s\n" % (dividend_payout) +
+                   "Pre Dividend: %s\n" % (pre_dividend_close) +
+                   "Post Dividend: %s\n" % (post_dividend_high) +
+                   "Difference Between High and Close: %s\n" % str(post_dividend_h - post_dividend_high))
 
-        # Make a nice data structure containing the dates
-        for ex_div in ex_dividend_soup:
-            if first == True:
-                first = False
-                continue
+        # Make sure that we would make at least 10 cents per share
+        if((pre_dividend_close + 0.10) < (post_dividend_high + dividend_payout)):
+            successes = successes + 1
+        else:
+            failures = failures + 1
 
-            div_element = ex_div.find_all('td')
+    return (successes, failures)
 
-            date = div_element[0].text.replace(",", "")
-            date = date.lower().split(" ")
 
-            # If the year is greater than 5 years ago, break.  Yahoo finance
-            # doesn't have history going back that far
-            if (CURRENT_YEAR - 5) > int(date[2]):
+def scan_ticker(req_proxy, ticker):
+    # Run the whole pipeline for a single ticker.  Returns (successes, failures) or
+    # None if the ticker couldn't be scanned.  Anything that goes wrong is contained to
+    # this ticker so that one bad page (or a Share() that yahoo rejects) can't take the
+    # whole run down with it.
+    # Each stage is a generator, so only one ex-dividend event is in flight at a time
+    # no matter how long the ticker's history is.
+    try:
+        ex_dividend_history = fetch_ex_dividend_history(req_proxy, ticker)
+
+        if ex_dividend_history is None:
+            return None
+
+        ex_dividend_stock_prices = fetch_ex_dividend_prices(ticker, ex_dividend_history)
+
+        return evaluate_ex_dividend_prices(ex_dividend_stock_prices)
+    except Exception as e:
+        scan_print("[ERROR]: Scan of %s failed: %s" % (ticker, str(e)))
+        return None
+
+
+# Marks the end of a pipeline queue
+END_OF_STREAM = None
+
+
+def feed_scan_queue(tickers, ticker_queue, worker_count, pipeline_errors):
+    # Producer stage.  put() blocks while the queue is full, which keeps the ticker
+    # source from running ahead of the workers.  If the ticker source blows up, the
+    # error is handed back to the main thread rather than dying with this one.
+    try:
+        for ticker in tickers:
+            ticker_queue.put(ticker)
+    except BaseException:
+        pipeline_errors.append(sys.exc_info())
+    finally:
+        for i in range(0, worker_count):
+            ticker_queue.put(END_OF_STREAM)
+
+
+def scan_worker(proxy_factory, ticker_queue, result_queue, pipeline_errors):
+    # Fetch/parse/evaluate stage.  Always sends END_OF_STREAM on the way out so the
+    # store stage never waits on a worker that has died.  scan_ticker() contains
+    # per-ticker errors, so anything caught here means the worker itself failed.
+    try:
+        req_proxy = None
+
+        while True:
+            ticker = ticker_queue.get()
+
+            if ticker is END_OF_STREAM:
                 break
 
-            date = "%s-%s-%s" % (date[2], MONTHS[date[0]], date[1])
+            # Built on first use so a run with nothing left to scan doesn't pay for it
+            if req_proxy is None:
+                req_proxy = proxy_factory()
 
-            amount = float(div_element[1].text.replace("$", ""))
+            result_queue.put((ticker, scan_ticker(req_proxy, ticker)))
+    except BaseException:
+        pipeline_errors.append(sys.exc_info())
+    finally:
+        result_queue.put(END_OF_STREAM)
+
+
+def run_scan_pipeline(proxy_factory, tickers, worker_count = PIPELINE_WORKERS):
+    # Streams tickers through the scan with bounded queues between stages and yields
+    # (ticker, result) pairs as they finish.  result is None if the ticker couldn't be
+    # scanned.  Finishing order is not the same as the order tickers came in.
+    # proxy_factory is called once in each worker to give it its own RequestProxy.
+    # If the producer or a worker fails, its exception is raised here once the
+    # pipeline has drained, so the caller never mistakes a partial scan for a full one.
+    ticker_queue = Queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    result_queue = Queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    pipeline_errors = []
 
-            ex_dividend_history.append((date, amount))
+    threads = [threading.Thread(target=feed_scan_queue,
+                                args=(tickers, ticker_queue, worker_count, pipeline_errors))]
 
-        # Get share data for each ex-dividend date.  Get the price on that day
-        # and the price the day before.
-        ticker_share = Share(ticker)
+    for i in range(0, worker_count):
+        threads.append(threading.Thread(target=scan_worker,
+                                        args=(proxy_factory, ticker_queue, result_queue, pipeline_errors)))
 
-        ex_dividend_stock_prices = []
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
-        for ex_div in ex_dividend_history:
+    finished_workers = 0
+
+    while finished_workers < worker_count:
+        # A get() with no timeout can't be interrupted, so poll to let Ctrl-C through
+        try:
+            item = result_queue.get(timeout=PIPELINE_POLL_INTERVAL)
+        except Queue.Empty:
+            continue
+
+        if item is END_OF_STREAM:
+            finished_workers = finished_workers + 1
+            continue
+
+        yield item
+
+    if len(pipeline_errors) > 0:
+        exc_type, exc_value, exc_traceback = pipeline_errors[0]
+        raise exc_type, exc_value, exc_traceback
+
+
+def unique_tickers(tickers):
+    # The same ticker can come in from the hard-coded list, the ex-dates file and the
+    # universe.  Only pass it along once, the first time it shows up.
+    seen_tickers = set()
+
+    for ticker in tickers:
+        if ticker == "" or ticker in seen_tickers:
+            continue
+
+        seen_tickers.add(ticker)
+
+        yield ticker
+
+
+def iter_ex_date_tickers(file_name):
+    dividend_file = open(file_name, "r")
+
+    for line in dividend_file:
+        # Skip over the per-day headers
+        if line.startswith("Date: "):
+            continue
+
+        yield line.split(',')[0].strip()
+
+    dividend_file.close()
+
+
+class scan_journal:
+    def __init__(self, journal_file_name = SCAN_JOURNAL):
+        # ticker -> (successes, failures) for every ticker finished by this run or
+        # by an earlier run that didn't make it to the end
+        self.journal_file_name = journal_file_name
+        self.results = {}
+
+        self.load()
+
+        # Append from here on out.  Every line is a complete record, so a crash can at
+        # worst lose the ticker that was in flight.
+        self.journal_file = open(self.journal_file_name, "a")
+
+    def load(self):
+        if not os.path.exists(self.journal_file_name):
+            return
+
+        journal_file = open(self.journal_file_name, "r+")
+        complete_length = 0
+
+        for line in journal_file.readlines():
+            # A line without a newline was cut off part way through a write
+            if not line.endswith("\n"):
+                break
+
+            complete_length = complete_length + len(line)
+
+            fields = line.strip().split(',')
+
+            if len(fields) != 3:
+                continue
 
             try:
-                ex_dividend_stock_prices.append((ticker_share.get_historical(subtract_one_day(ex_div[0]),
-                    ex_div[0]), ex_div[1]))
-            except Exception as e:
-                import code; code.interact(local=locals())
+                self.results[fields[0]] = (int(fields[1]), int(fields[2]))
+            except ValueError:
+                continue
+
+        # Chop off the torn line so that new records don't get glued onto the end of it
+        journal_file.truncate(complete_length)
+        journal_file.close()
+
+    def is_done(self, ticker):
+        return ticker in self.results
+
+    def record(self, ticker, result):
+        self.results[ticker] = result
+
+        self.journal_file.write("%s,%s,%s\n" % (ticker, result[0], result[1]))
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
 
-            time.sleep(0.1)
+    @staticmethod
+    def iter_results(results_file_name):
+        # Streams (ticker, line) out of a results file written by compact(), which keeps
+        # it sorted by ticker
+        if not os.path.exists(results_file_name):
+            return
 
-        successes = 0
-        failures = 0
+        results_file = open(results_file_name, "r")
 
-        # Now, see if the stock price actually recovered the day after the dividend got paid out
-        for dividend_event in ex_dividend_stock_prices:
+        for line in results_file:
+            fields = line.strip().split(',')
 
-            # Some of the dividend_events have a length of only 1.  Figure out why this is later on
-            if len(dividend_event[0]) != 2:
+            if len(fields) != 3:
                 continue
 
+            yield (fields[0], line)
+
+        results_file.close()
+
+    def compact(self, results_file_name = SCAN_RESULTS):
+        # The run finished.  Merge the journal into the results file, one line per
+        # ticker, and get rid of the journal so the next run starts from scratch.  Most
+        # runs only scan the tickers that changed, so every ticker this run didn't touch
+        # keeps the result from whichever run scanned it last.  Both sides are sorted,
+        # so the old results are streamed through rather than loaded.
+        self.journal_file.close()
+
+        new_tickers = sorted(self.results.keys())
+        position = 0
+
+        temp_file_name = results_file_name + ".tmp"
+        results_file = open(temp_file_name, "w")
+
+        for ticker, line in scan_journal.iter_results(results_file_name):
+            while position < len(new_tickers) and new_tickers[position] < ticker:
+                new_ticker = new_tickers[position]
+                results_file.write("%s,%s,%s\n" % (new_ticker, self.results[new_ticker][0], self.results[new_ticker][1]))
+                position = position + 1
+
+            # Superseded by this run.  The new result gets written on the next pass.
+            if ticker in self.results:
+                continue
+
+            results_file.write(line)
+
+        for new_ticker in new_tickers[position:]:
+            results_file.write("%s,%s,%s\n" % (new_ticker, self.results[new_ticker][0], self.results[new_ticker][1]))
+
+        results_file.close()
+
+        os.rename(temp_file_name, results_file_name)
+        os.remove(self.journal_file_name)
+
+
+def usage():
+    print "Usage: %s [-f|--full] [-r|--restart] [-w|--workers <count>]" % sys.argv[0]
+    print "  -f, --full     Scan every ticker in %s instead of only the changed ones" % nasdaq_file
+    print "  -r, --restart  Throw away any unfinished run instead of resuming it"
+    print "  -w, --workers  Number of tickers to scan at once (default %s)" % PIPELINE_WORKERS
+
+
+def main(argc, argv):
+
+    try:
+        opts, args = getopt.getopt(argv[1:], "frw:h", ["full", "restart", "workers=", "help"])
+    except getopt.GetoptError as e:
+        print "[ERROR]: %s" % str(e)
+        usage()
+        sys.exit(2)
+
+    full_scan = False
+    restart = False
+    worker_count = PIPELINE_WORKERS
+
+    for opt, arg in opts:
+        if opt in ("-f", "--full"):
+            full_scan = True
+        elif opt in ("-r", "--restart"):
+            restart = True
+        elif opt in ("-w", "--workers"):
             try:
-                dividend_payout = float(dividend_event[1])
-                pre_dividend_close = float(dividend_event[0][1]['Close'])
-                post_dividend_open = float(dividend_event[0][1]['Open'])
-                post_dividend_h = float(dividend_event[0][1]['High'])
-                post_dividend_high = float(dividend_event[0][0]['Close'])
+                worker_count = int(arg)
+            except ValueError:
+                worker_count = 0
 
+            if worker_count < 1:
+                print "[ERROR]: The number of workers must be a positive integer."
+                usage()
+                sys.exit(2)
+        elif opt in ("-h", "--help"):
+            usage()
+            sys.exit(0)
 
-                if post_dividend_open == post_dividend_h:
-                    post_dividend_h = 99999.00
+    if restart is True and os.path.exists(SCAN_JOURNAL):
+        os.remove(SCAN_JOURNAL)
 
-            except Exception as e:
-                import code; code.interact(local=locals())
+    div_stripper = dividend_stripper()
 
-            print "Divident Payout: %s" % (dividend_payout)
-            print "Pre Dividend: %s" % (pre_dividend_close)
-            print "Post Dividend: %s" % (post_dividend_high)
-            print "Difference Between High and Close: %s" % str(post_dividend_h - post_dividend_high)
-            print ""
+    # Pick up where an interrupted run left off
+    journal = scan_journal()
 
-            # Make sure that we would make at least 10 cents per share
-            if((pre_dividend_close + 0.10) < (post_dividend_high + dividend_payout)):
-                successes = successes + 1
-            else:
-                failures = failures + 1
+    # Can eventually read this in from a file
+    #tickers_to_test = ['XOM', 'BMY', 'EAT', 'KO', 'CRF', 'GLDI', 'GE']
+    #tickers_to_test = ['GILD', 'AAT', 'AMOT', 'BBBY']
+    #tickers_to_test = ['AIMC', 'ALOG', 'AME', 'ARII']
+    tickers_to_test = ['ARII']# 'DIA', 'XOM', 'GE']
 
-        print "\n\nSuccesses: %s" % (successes)
-        print "Failures: %s" % (failures)
+    # A resumed run keeps the ex-dividend dates the interrupted run was working from.
+    # Fetching them again would be slow and could change which tickers are in the run.
+    if len(journal.results) > 0 and os.path.exists(UPCOMING_EX_DATES):
+        print "Resuming run: %s tickers already finished" % len(journal.results)
+    else:
+        # Set up proxy generator in order to prevent ipbans
+        update_ex_div_dates(new_request_proxy())
 
+    # Only the tickers that changed since the universe changes were last handled need to
+    # be rescanned.  Mirror those changes into the database while we're at it.  They are
+    # applied oldest first and if one can't be applied, it and everything after it stay
+    # queued for the next run.
+    applied_changes = []
 
-        print "\n\n\n"
+    for changes_file_name, universe_delta in UniverseDelta.load_pending():
+        if universe_delta.write_to_database(div_stripper.stock_database) is False:
+            print "[ERROR]: Could not apply %s to the database.  Leaving it queued." % changes_file_name
+            break
 
+        applied_changes.append((changes_file_name, universe_delta))
 
-        pass
+    if full_scan is True:
+        universe_tickers = (ticker for company_name, ticker, exchange in TickerUniverse.iter_snapshot(nasdaq_file))
+    else:
+        universe_tickers = UniverseDelta.pending_changed_tickers([delta for name, delta in applied_changes])
+
+    # Tickers are streamed in from the dividend file and the universe as the workers
+    # ask for them rather than being read into a list up front
+    tickers_to_test = (ticker for ticker in unique_tickers(itertools.chain(tickers_to_test,
+        iter_ex_date_tickers(UPCOMING_EX_DATES), universe_tickers)) if not journal.is_done(ticker))
+
+    # Store stage.  Results are journaled as soon as they come off the pipeline.  If
+    # the pipeline fails part way, the exception skips the compaction and the
+    # acknowledgement below, and the next run resumes from the journal.
+    for ticker, result in run_scan_pipeline(new_request_proxy, tickers_to_test, worker_count):
+
+        # If something went wrong collecting data, just go on to the next ticker.  It
+        # isn't journaled, so a resumed run will give it another shot.
+        if result is None:
+            continue
+
+        journal.record(ticker, result)
+
+        scan_print("Ticker: %s\n" % ticker +
+                   "Successes: %s\n" % (result[0]) +
+                   "Failures: %s\n" % (result[1]) +
+                   "\n")
+
+    journal.compact()
+
+    # Every changed ticker has been scanned.  Those changes are done with.
+    for changes_file_name, universe_delta in applied_changes:
+        UniverseDelta.acknowledge(changes_file_name)
+
+    fetch_coalescer.report()
+
+    print "Peak RSS: %s KB" % (peak_rss_kb())
 
     print "\n\n"
 
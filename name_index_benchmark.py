@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+# ---------------------------------------------------------------------------- #
+# Developer: Andrew Kirfman                                                    #
+# Project: Dividend Stripper Application                                       #
+#                                                                              #
+# File ./name_index_benchmark.py                                               #
+# ---------------------------------------------------------------------------- #
+
+# Times CompanyNameIndex lookups against a synthetic universe about the size of
+# NASDAQ + NYSE.  Every name is one distinctive word plus one to three of the same
+# handful of industry words real listings are full of ("financial", "bancorp", ...),
+# so the postings for most of a query's n-grams are very long.
+
+import sys
+import time
+import random
+
+from nasdaq_scraper import TickerUniverse, CompanyNameIndex, NAME_INDEX_MIN_SCORE
+
+UNIVERSE_SIZE = 7000
+LOOKUPS = 5000
+
+# Lookups have to average under this many milliseconds
+TARGET_MS = 1.0
+
+# Most of the misspelled listed names that may resolve to some other ticker (or
+# nothing).  Dropping a letter out of a short name can legitimately make it closer to
+# a different company, so this isn't zero.
+MAX_MISRESOLVED_FRACTION = 0.01
+
+# Number of lookups of each kind checked against a brute force search
+BRUTE_FORCE_LOOKUPS = 500
+
+industry_words = ['financial', 'bancorp', 'bancshares', 'technologies', 'pharmaceuticals',
+                  'therapeutics', 'energy', 'resources', 'capital', 'partners', 'systems',
+                  'industries', 'international', 'healthcare', 'realty', 'trust', 'income',
+                  'global', 'american', 'first', 'national', 'semiconductor', 'biosciences']
+
+corporate_suffixes = ['Inc', 'Corp', 'Corporation', 'Holdings Inc', 'Group', 'Ltd', 'plc']
+
+
+def random_ticker(generator):
+    return "".join([generator.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for i in range(0, 4)])
+
+
+def random_word(generator):
+    # Something pronounceable enough to pass for a company's distinctive name
+    consonants = "bcdfghjklmnprstvwz"
+    vowels = "aeiou"
+
+    return "".join([generator.choice(consonants) + generator.choice(vowels)
+                    for i in range(0, generator.randint(2, 4))])
+
+
+def random_company_name(generator):
+    words = [random_word(generator)]
+    words = words + generator.sample(industry_words, generator.randint(1, 3))
+
+    return " ".join([word.capitalize() for word in words] + [generator.choice(corporate_suffixes)])
+
+
+def misspell(generator, company_name):
+    # Drop one letter somewhere in the name, the way news copy tends to
+    position = generator.randint(0, len(company_name) - 1)
+
+    return company_name[:position] + company_name[position + 1:]
+
+
+def time_lookups(index, names):
+    # Returns the per lookup times in milliseconds, sorted, and the lookup results in
+    # the same order as names
+    timings = []
+    results = []
+
+    for name in names:
+        start_time = time.time()
+        results.append(index.lookup(name))
+        timings.append((time.time() - start_time) * 1000)
+
+    timings.sort()
+
+    return (timings, results)
+
+
+def brute_force_lookup(index, company_name):
+    # Scores company_name against every name in the index.  Same tie breaking and
+    # min_score cut off as CompanyNameIndex.lookup, so the results should be identical.
+    query_grams = CompanyNameIndex.name_grams(CompanyNameIndex.key_name(company_name))
+
+    best_ticker = None
+    best_score = 0.0
+
+    for name, name_grams in index.key_grams.items():
+        score = 2.0 * len(query_grams & name_grams) / (len(query_grams) + len(name_grams))
+        ticker = min(index.exact_names[name])
+
+        if score > best_score or (score == best_score and best_ticker is not None and ticker < best_ticker):
+            best_ticker = ticker
+            best_score = score
+
+    if best_score < NAME_INDEX_MIN_SCORE:
+        return (None, 0.0)
+
+    return (best_ticker, best_score)
+
+
+def brute_force_mismatches(index, names, results):
+    # How many of the first BRUTE_FORCE_LOOKUPS names the index got a different answer
+    # for than a brute force search
+    return len([i for i in range(0, min(BRUTE_FORCE_LOOKUPS, len(names)))
+                if results[i] != brute_force_lookup(index, names[i])])
+
+
+def report(title, timings):
+    mean_ms = sum(timings) / len(timings)
+
+    print "%s: %s" % (title, len(timings))
+    print "  mean: %.3f ms" % (mean_ms)
+    print "  p50:  %.3f ms" % (timings[len(timings) / 2])
+    print "  p99:  %.3f ms" % (timings[int(len(timings) * 0.99)])
+
+    return mean_ms
+
+
+def main(argc, argv):
+    generator = random.Random(470)
+
+    universe = TickerUniverse()
+
+    # (company name, ticker) for everything in the universe
+    listings = []
+
+    while len(universe) < UNIVERSE_SIZE:
+        company_name = random_company_name(generator)
+        ticker = random_ticker(generator)
+
+        if universe.add_listing(company_name, ticker, "NYSE"):
+            listings.append((company_name, ticker))
+
+    start_time = time.time()
+    index = CompanyNameIndex.from_universe(universe)
+    build_ms = (time.time() - start_time) * 1000
+
+    print "Universe: %s names, index built in %.1f ms" % (len(index), build_ms)
+
+    # Misspelled names of listed companies: what resolving a news or dividend feed
+    # mostly looks like.  Each one should resolve back to the ticker it came from.
+    listed_queries = [generator.choice(listings) for i in range(0, LOOKUPS)]
+    listed_names = [misspell(generator, company_name) for company_name, ticker in listed_queries]
+    listed_timings, listed_results = time_lookups(index, listed_names)
+
+    misresolved = len([i for i in range(0, LOOKUPS) if listed_results[i][0] != listed_queries[i][1]])
+    misresolved_fraction = float(misresolved) / LOOKUPS
+
+    # Names that aren't listed at all and only share industry words with the universe
+    unlisted_names = [random_company_name(generator) for i in range(0, LOOKUPS)]
+    unlisted_timings, unlisted_results = time_lookups(index, unlisted_names)
+
+    # Names made of nothing but industry words.  They can't be told apart by a
+    # distinctive word, which makes them the easiest ones to get wrong.
+    common_names = [" ".join(generator.sample(industry_words, 3)) for i in range(0, LOOKUPS)]
+    common_timings, common_results = time_lookups(index, common_names)
+
+    mismatches = brute_force_mismatches(index, listed_names, listed_results) + \
+                 brute_force_mismatches(index, unlisted_names, unlisted_results) + \
+                 brute_force_mismatches(index, common_names, common_results)
+
+    mean_ms = [report("Fuzzy lookups of listed companies", listed_timings)]
+    print "  resolved wrong or not at all: %s (%.2f%%)" % (misresolved, misresolved_fraction * 100)
+
+    mean_ms.append(report("Lookups of unlisted companies", unlisted_timings))
+    mean_ms.append(report("Lookups made only of industry words", common_timings))
+
+    print "Lookups different from brute force: %s of %s" % (mismatches, 3 * BRUTE_FORCE_LOOKUPS)
+
+    failed = False
+
+    if max(mean_ms) >= TARGET_MS:
+        print "[ERROR]: Mean lookup time is over the %.1f ms target" % (TARGET_MS)
+        failed = True
+
+    if misresolved_fraction > MAX_MISRESOLVED_FRACTION:
+        print "[ERROR]: More than %.1f%% of listed companies resolved to the wrong ticker" \
+            % (MAX_MISRESOLVED_FRACTION * 100)
+        failed = True
+
+    if mismatches > 0:
+        print "[ERROR]: %s lookups didn't find the best match" % (mismatches)
+        failed = True
+
+    if failed is True:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(len(sys.argv), sys.argv)
@@ -14,9 +14,16 @@
 from bs4 import BeautifulSoup, SoupStrainer
 import requests
 import copy
+import math
+import unicodedata
 from nltk.stem import WordNetLemmatizer
 from nltk.stem.porter import PorterStemmer
 import time
+import sys
+import os
+import getopt
+import re
+import resource
 
 # --------------------------------------------------------------------------- #
 # Global Variables                                                            #
@@ -31,6 +38,44 @@ PAGES_IN_NYSE_DATABASE = 16
 
 default_normalization_steps = ['punctuation', 'special_character_removal', 'case_folding']
 
+# Every run that changes the universe queues its added/removed/renamed tickers in a
+# numbered changes file so that downstream per-ticker jobs only have to look at what
+# changed.  Consumers apply the queued files oldest first and remove each one once it
+# has been fully handled, so no run's changes get lost or handled twice.
+universe_changes_file = "universe_changes.%06d.txt"
+universe_changes_pattern = re.compile(r'^universe_changes\.(\d+)\.txt$')
+UNIVERSE_TABLE = "ticker_universe"
+
+# If more than this fraction of an exchange's tickers disappear in one run, it is far
+# more likely that the screener dropped pages than that the companies delisted.
+MAX_REMOVED_FRACTION = 0.05
+
+# The exchanges don't agree on how to write share classes (BRK.B, BRK/B, BRK-B).
+# Everything gets folded to a '.' separator.  Preferred issues (ABR^A) become ABR.PA.
+share_class_separators = ['/', '-', ' ']
+preferred_separator = '^'
+
+# A canonical ticker is a run of capitals/digits with at most one class suffix
+valid_ticker_pattern = re.compile(r'^[A-Z][A-Z0-9]*(\.[A-Z0-9]+)?$')
+
+# Trailing descriptors on ADR company names.  These get stripped so that an ADR
+# listed on one exchange matches its name on the other.
+adr_name_suffixes = ['american depositary shares', 'american depositary share',
+                     'american depository shares', 'american depository share',
+                     'sponsored adr', 'adr', 'ads']
+
+# Size of the character n-grams used by the company name index
+NAME_INDEX_GRAM_SIZE = 3
+
+# Minimum similarity (Dice coefficient over n-grams) for a fuzzy name match
+NAME_INDEX_MIN_SCORE = 0.6
+
+# Words that show up in so many company names that they only add noise to a lookup
+# (and very long posting lists to the index)
+company_name_stop_words = ['the', 'inc', 'incorporated', 'corp', 'corporation', 'co', 'company',
+                           'ltd', 'limited', 'plc', 'llc', 'lp', 'sa', 'nv', 'ag', 'group',
+                           'holdings', 'holding', 'common', 'stock', 'shares', 'class']
+
 
 class NormalizeText:
     def __init__(self):
@@ -63,6 +108,17 @@ class NormalizeText:
         return token_stream
 
 
+    @staticmethod
+    def fold_to_ascii(text):
+        # BeautifulSoup hands back unicode.  Fold accented characters down to their plain
+        # ASCII letters (u'Nestl\xe9' -> 'Nestle') and drop anything that has no ASCII form
+        # so the result can go through the str based normalizations above.
+        if 'unicode' in str(type(text)):
+            return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore')
+
+        return str(text)
+
+
     @staticmethod
     def tokenize_text(token_stream):
         # Right now, this module is pretty basic.  It just takes in a string and splits it on spaces.
@@ -168,10 +224,602 @@ class NormalizeText:
         return temp_list_to_lemmatize
 
 
+class TickerUniverse:
+    def __init__(self):
+        # Maps canonical ticker -> (normalized company name, exchange)
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ticker):
+        return ticker in self.entries
+
+    @staticmethod
+    def canonical_ticker(raw_ticker):
+        # Returns the canonical form of a ticker or None if it doesn't look like one.
+        # This replaces the old "no lowercase characters" heuristic, which let through
+        # things like empty strings and numbers.
+        if 'str' not in str(type(raw_ticker)) and 'unicode' not in str(type(raw_ticker)):
+            return None
+
+        ticker = NormalizeText.fold_to_ascii(raw_ticker).strip()
+
+        # Screener cells with lowercase text in the ticker column are leftover junk
+        if any(c.islower() for c in ticker):
+            return None
+
+        for separator in share_class_separators:
+            ticker = ticker.replace(separator, ".")
+
+        ticker = ticker.replace(preferred_separator, ".P")
+
+        if valid_ticker_pattern.match(ticker) is None:
+            return None
+
+        return ticker
+
+    @staticmethod
+    def canonical_company_name(company_name):
+        company_name = NormalizeText.normalize_text(company_name).strip()
+
+        for suffix in adr_name_suffixes:
+            if company_name.endswith(" " + suffix):
+                company_name = company_name[:-len(suffix)].strip()
+                break
+
+        return company_name
+
+    def add_listing(self, company_name, ticker, exchange):
+        # Returns True if the listing was added.  Invalid tickers and tickers that are
+        # already in the universe (the same security showing up on both screeners) are
+        # dropped.  The first exchange to list a ticker wins.
+        ticker = TickerUniverse.canonical_ticker(ticker)
+
+        if ticker is None or ticker in self.entries:
+            return False
+
+        self.entries[ticker] = (TickerUniverse.canonical_company_name(NormalizeText.fold_to_ascii(company_name)),
+                                exchange)
+
+        return True
+
+    def keep_missing_listings(self, previous_universe, exchanges):
+        # Carry over every listing on one of exchanges that was in previous_universe but
+        # didn't come back this time
+        for ticker, entry in previous_universe.entries.items():
+            if entry[1] in exchanges and ticker not in self.entries:
+                self.entries[ticker] = entry
+
+    @staticmethod
+    def load(file_name):
+        # Read in a previously saved snapshot.  A missing file is just an empty universe.
+        universe = TickerUniverse()
+
+        if not os.path.exists(file_name):
+            return universe
+
+        for company_name, ticker, exchange in TickerUniverse.iter_snapshot(file_name):
+            universe.add_listing(company_name, ticker, exchange)
+
+        return universe
+
+    @staticmethod
+    def iter_snapshot(file_name):
+        # Stream (company name, ticker, exchange) out of a saved snapshot one line at a time
+        if not os.path.exists(file_name):
+            return
+
+        snapshot_file = open(file_name, "r")
+
+        for line in snapshot_file:
+            fields = line.strip("\n").split(',')
+
+            if len(fields) != 3:
+                continue
+
+            yield (fields[0], fields[1], fields[2])
+
+        snapshot_file.close()
+
+    def save(self, file_name):
+        # Write to a temporary file and move it into place so that a crash halfway
+        # through never leaves a truncated snapshot behind
+        temp_file_name = file_name + ".tmp"
+        snapshot_file = open(temp_file_name, "w")
+
+        for ticker in sorted(self.entries.keys()):
+            company_name, exchange = self.entries[ticker]
+            snapshot_file.write("%s,%s,%s\n" % (company_name, ticker, exchange))
+
+        snapshot_file.close()
+
+        os.rename(temp_file_name, file_name)
+
+    def diff(self, previous_universe):
+        delta = UniverseDelta()
+
+        for ticker, entry in self.entries.items():
+            if ticker not in previous_universe.entries:
+                delta.added[ticker] = entry
+            elif previous_universe.entries[ticker] != entry:
+                delta.updated[ticker] = entry
+
+        for ticker, entry in previous_universe.entries.items():
+            if ticker not in self.entries:
+                delta.removed[ticker] = entry
+
+        # A ticker change shows up as one removal and one addition with the same
+        # company name.  Only pair them up when the name is unambiguous.
+        removed_by_name = {}
+        for ticker, entry in delta.removed.items():
+            removed_by_name.setdefault(entry[0], []).append(ticker)
+
+        added_by_name = {}
+        for ticker, entry in delta.added.items():
+            added_by_name.setdefault(entry[0], []).append(ticker)
+
+        for company_name, added_tickers in added_by_name.items():
+            removed_tickers = removed_by_name.get(company_name, [])
+
+            if company_name == "" or len(added_tickers) != 1 or len(removed_tickers) != 1:
+                continue
+
+            new_ticker = added_tickers[0]
+            old_ticker = removed_tickers[0]
+
+            delta.renamed[new_ticker] = (old_ticker, ) + delta.added.pop(new_ticker)
+            del delta.removed[old_ticker]
+
+        return delta
+
+
+class UniverseDelta:
+    def __init__(self):
+        # ticker -> (company name, exchange)
+        self.added = {}
+        self.removed = {}
+        self.updated = {}
+
+        # new ticker -> (old ticker, company name, exchange)
+        self.renamed = {}
+
+    def is_empty(self):
+        return len(self.added) == 0 and len(self.removed) == 0 and \
+            len(self.updated) == 0 and len(self.renamed) == 0
+
+    def changed_tickers(self):
+        # The tickers that downstream per-ticker jobs need to (re)process.  Removed
+        # tickers are not included since there is nothing left to fetch for them.
+        return sorted(list(self.added.keys()) + list(self.updated.keys()) + list(self.renamed.keys()))
+
+    def removed_fractions(self, previous_universe):
+        # exchange -> fraction of that exchange's tickers in previous_universe that this
+        # delta removes.  Tickers that were renamed or moved exchanges don't count.
+        previous_counts = {}
+        for ticker, entry in previous_universe.entries.items():
+            previous_counts[entry[1]] = previous_counts.get(entry[1], 0) + 1
+
+        removed_counts = {}
+        for ticker, entry in self.removed.items():
+            removed_counts[entry[1]] = removed_counts.get(entry[1], 0) + 1
+
+        return dict([(exchange, float(removed_counts.get(exchange, 0)) / previous_counts[exchange])
+                     for exchange in previous_counts.keys()])
+
+    def save(self, file_name):
+        # Written as a CSV with elements of the form:
+        # <change>,<company name>,<ticker symbol>,<exchange>,<previous ticker symbol>
+        changes_file = open(file_name, "w")
+
+        for change, entries in [('added', self.added), ('removed', self.removed), ('updated', self.updated)]:
+            for ticker in sorted(entries.keys()):
+                company_name, exchange = entries[ticker]
+                changes_file.write("%s,%s,%s,%s,\n" % (change, company_name, ticker, exchange))
+
+        for ticker in sorted(self.renamed.keys()):
+            old_ticker, company_name, exchange = self.renamed[ticker]
+            changes_file.write("renamed,%s,%s,%s,%s\n" % (company_name, ticker, exchange, old_ticker))
+
+        changes_file.close()
+
+    def queue(self):
+        # Add this delta to the end of the pending changes.  Returns the file it went to.
+        pending_files = UniverseDelta.pending_files()
+
+        if len(pending_files) == 0:
+            sequence = 1
+        else:
+            sequence = int(universe_changes_pattern.match(pending_files[-1]).group(1)) + 1
+
+        file_name = universe_changes_file % sequence
+
+        # Consumers only look for finished file names, so write it out under a temporary name first
+        self.save(file_name + ".tmp")
+        os.rename(file_name + ".tmp", file_name)
+
+        return file_name
+
+    @staticmethod
+    def pending_files():
+        # Queued changes files that haven't been acknowledged yet, oldest first
+        matches = [universe_changes_pattern.match(file_name) for file_name in os.listdir(".")]
+
+        return [match.group(0) for match in sorted([m for m in matches if m is not None],
+                key=lambda m: int(m.group(1)))]
+
+    @staticmethod
+    def load_pending():
+        return [(file_name, UniverseDelta.load(file_name)) for file_name in UniverseDelta.pending_files()]
+
+    @staticmethod
+    def acknowledge(file_name):
+        # The consumer is completely done with this delta
+        os.remove(file_name)
+
+    @staticmethod
+    def pending_changed_tickers(deltas):
+        # changed_tickers() across several deltas applied in order.  A ticker that a later
+        # delta removes (or renames away) is dropped again.
+        changed_tickers = []
+
+        for delta in deltas:
+            gone_tickers = set(delta.removed.keys() + [entry[0] for entry in delta.renamed.values()])
+            changed_tickers = [ticker for ticker in changed_tickers if ticker not in gone_tickers]
+
+            for ticker in delta.changed_tickers():
+                if ticker not in changed_tickers:
+                    changed_tickers.append(ticker)
+
+        return changed_tickers
+
+    @staticmethod
+    def load(file_name):
+        delta = UniverseDelta()
+
+        if not os.path.exists(file_name):
+            return delta
+
+        changes_file = open(file_name, "r")
+
+        for line in changes_file:
+            fields = line.strip("\n").split(',')
+
+            if len(fields) != 5:
+                continue
+
+            change, company_name, ticker, exchange, old_ticker = fields
+
+            if change == 'renamed':
+                delta.renamed[ticker] = (old_ticker, company_name, exchange)
+            elif change in ['added', 'removed', 'updated']:
+                getattr(delta, change)[ticker] = (company_name, exchange)
+
+        changes_file.close()
+
+        return delta
+
+    def write_to_database(self, database):
+        # Apply only the changes to the universe table.  database is anything with an
+        # issue_db_command method (e.g. dividend_stripper's stock_database).  All of the
+        # statements are idempotent so re-applying the same delta is harmless.  Returns
+        # False if any of the statements failed.
+        results = []
+
+        results.append(database.issue_db_command("CREATE TABLE IF NOT EXISTS %s (ticker VARCHAR(16) PRIMARY KEY, "
+            "company_name VARCHAR(255), exchange VARCHAR(16));" % UNIVERSE_TABLE))
+
+        for ticker in sorted(self.removed.keys()):
+            results.append(database.issue_db_command("DELETE FROM %s WHERE ticker = '%s';"
+                % (UNIVERSE_TABLE, ticker)))
+
+        for ticker in sorted(self.renamed.keys()):
+            results.append(database.issue_db_command("DELETE FROM %s WHERE ticker = '%s';"
+                % (UNIVERSE_TABLE, self.renamed[ticker][0])))
+
+        upserts = [(ticker, entry[0], entry[1]) for ticker, entry in self.added.items() + self.updated.items()]
+        upserts = upserts + [(ticker, entry[1], entry[2]) for ticker, entry in self.renamed.items()]
+
+        # Company names have already had their punctuation (including quotes) stripped
+        # by NormalizeText, so they can be dropped straight into the statement.
+        for ticker, company_name, exchange in sorted(upserts):
+            results.append(database.issue_db_command("REPLACE INTO %s (ticker, company_name, exchange) "
+                "VALUES ('%s', '%s', '%s');" % (UNIVERSE_TABLE, ticker, company_name, exchange)))
+
+        return False not in results
+
+
+class CompanyNameIndex:
+    def __init__(self):
+        # ticker -> key name (see key_name below)
+        self.ticker_names = {}
+
+        # key name -> set of tickers with that name.  Doubles as the exact match fast path.
+        # Share classes and cross listings share a name, so the n-gram side of the index
+        # is kept per name rather than per ticker.
+        self.exact_names = {}
+
+        # key name -> set of n-grams in that name
+        self.key_grams = {}
+
+        # Every key name gets a small integer id while it's in the index.  The posting
+        # lists are bitmasks over those ids, which lets a lookup count every name's
+        # overlap with the query with a handful of big integer operations per n-gram
+        # rather than by touching names one at a time.
+        self.name_ids = {}
+        self.id_names = []
+        self.free_ids = []
+
+        # n-gram -> bitmask of the names containing it (the postings)
+        self.gram_masks = {}
+
+        # number of n-grams in a name -> bitmask of the names that size
+        self.size_masks = {}
+
+    def __len__(self):
+        return len(self.ticker_names)
+
+    @staticmethod
+    def key_name(company_name):
+        # Run free text through the same normalization the scraper applies to
+        # everything it writes, then drop the corporate boilerplate words
+        company_name = TickerUniverse.canonical_company_name(NormalizeText.fold_to_ascii(company_name))
+
+        words = [word for word in company_name.split(" ") if word != "" and word not in company_name_stop_words]
+
+        # Some names are nothing but boilerplate ("The Company Inc").  Keep them as-is.
+        if len(words) == 0:
+            return company_name
+
+        return " ".join(words)
+
+    @staticmethod
+    def min_shared_grams(query_size, name_size, threshold):
+        # Fewest n-grams a name_size n-gram name has to share with a query_size n-gram
+        # query to reach a Dice score of threshold
+        return max(1, int(math.ceil(threshold * (query_size + name_size) / 2.0 - 1e-9)))
+
+    @staticmethod
+    def name_grams(key_name):
+        padded_name = " " + key_name + " "
+
+        if len(padded_name) < NAME_INDEX_GRAM_SIZE:
+            return set([padded_name])
+
+        return set([padded_name[i:i + NAME_INDEX_GRAM_SIZE]
+                    for i in range(0, len(padded_name) - NAME_INDEX_GRAM_SIZE + 1)])
+
+    @staticmethod
+    def count_bits(masks):
+        # Adds up the bitmasks in masks bit by bit.  Returns the counts as a list of bit
+        # planes, least significant first: plane i has bit n set if the count for bit n
+        # has bit i set.
+        planes = []
+
+        for mask in masks:
+            carry = mask
+
+            for i in range(0, len(planes)):
+                if carry == 0:
+                    break
+
+                planes[i], carry = planes[i] ^ carry, planes[i] & carry
+
+            if carry != 0:
+                planes.append(carry)
+
+        return planes
+
+    @staticmethod
+    def at_least(planes, minimum, candidates):
+        # Narrows the bitmask candidates down to the bits whose count (see count_bits)
+        # is at least minimum
+        if minimum >= (1 << len(planes)):
+            return 0
+
+        # Walk the planes from the most significant end.  greater holds the bits already
+        # known to be over minimum, equal the ones that match it so far.
+        greater = 0
+        equal = candidates
+
+        for i in range(len(planes) - 1, -1, -1):
+            if minimum & (1 << i):
+                equal = equal & planes[i]
+            else:
+                greater = greater | (equal & planes[i])
+                equal = equal & ~planes[i]
+
+        return greater | equal
+
+    @staticmethod
+    def from_universe(universe):
+        index = CompanyNameIndex()
+
+        for ticker, entry in universe.entries.items():
+            index.add(ticker, entry[0])
+
+        return index
+
+    def add(self, ticker, company_name):
+        if ticker in self.ticker_names:
+            self.remove(ticker)
+
+        key_name = CompanyNameIndex.key_name(company_name)
+
+        if key_name == "":
+            return
+
+        self.ticker_names[ticker] = key_name
+
+        if key_name in self.exact_names:
+            self.exact_names[key_name].add(ticker)
+            return
+
+        self.exact_names[key_name] = set([ticker])
+
+        grams = CompanyNameIndex.name_grams(key_name)
+        self.key_grams[key_name] = grams
+
+        # Reuse the ids of removed names so the bitmasks don't keep growing
+        if len(self.free_ids) > 0:
+            name_id = self.free_ids.pop()
+            self.id_names[name_id] = key_name
+        else:
+            name_id = len(self.id_names)
+            self.id_names.append(key_name)
+
+        self.name_ids[key_name] = name_id
+        name_bit = 1 << name_id
+
+        for gram in grams:
+            self.gram_masks[gram] = self.gram_masks.get(gram, 0) | name_bit
+
+        self.size_masks[len(grams)] = self.size_masks.get(len(grams), 0) | name_bit
+
+    def remove(self, ticker):
+        if ticker not in self.ticker_names:
+            return
+
+        key_name = self.ticker_names.pop(ticker)
+        self.exact_names[key_name].discard(ticker)
+
+        # Other tickers still go by this name
+        if len(self.exact_names[key_name]) > 0:
+            return
+
+        del self.exact_names[key_name]
+        grams = self.key_grams.pop(key_name)
+
+        name_id = self.name_ids.pop(key_name)
+        self.id_names[name_id] = None
+        self.free_ids.append(name_id)
+        name_bit = 1 << name_id
+
+        for gram in grams:
+            self.gram_masks[gram] = self.gram_masks[gram] & ~name_bit
+
+            if self.gram_masks[gram] == 0:
+                del self.gram_masks[gram]
+
+        self.size_masks[len(grams)] = self.size_masks[len(grams)] & ~name_bit
+
+        if self.size_masks[len(grams)] == 0:
+            del self.size_masks[len(grams)]
+
+    def apply_delta(self, delta):
+        # Incrementally bring the index up to date with a UniverseDelta instead of
+        # rebuilding it from the whole universe
+        for ticker in delta.removed.keys():
+            self.remove(ticker)
+
+        for ticker, entry in delta.renamed.items():
+            self.remove(entry[0])
+            self.add(ticker, entry[1])
+
+        for ticker, entry in delta.added.items() + delta.updated.items():
+            self.add(ticker, entry[0])
+
+    def mask_names(self, mask):
+        # The key names whose ids are set in mask
+        names = []
+
+        while mask != 0:
+            lowest_bit = mask & -mask
+            names.append(self.id_names[lowest_bit.bit_length() - 1])
+            mask = mask ^ lowest_bit
+
+        return names
+
+    def best_match(self, query_grams, names):
+        # Returns (ticker, score) for the highest scoring of names, or (None, 0.0)
+        best_ticker = None
+        best_score = 0.0
+
+        for name in names:
+            name_grams = self.key_grams[name]
+            score = 2.0 * len(query_grams & name_grams) / (len(query_grams) + len(name_grams))
+
+            if score < best_score:
+                continue
+
+            ticker = min(self.exact_names[name])
+
+            if score > best_score or ticker < best_ticker:
+                best_ticker = ticker
+                best_score = score
+
+        return (best_ticker, best_score)
+
+    def lookup(self, company_name, min_score = NAME_INDEX_MIN_SCORE):
+        # Returns (ticker, score) for the best matching company or (None, 0.0) if nothing
+        # scores at least min_score.  Ties go to the alphabetically first ticker so
+        # results are stable from run to run.  Every name in the index is considered.
+        key_name = CompanyNameIndex.key_name(company_name)
+
+        if key_name == "":
+            return (None, 0.0)
+
+        if key_name in self.exact_names:
+            return (min(self.exact_names[key_name]), 1.0)
+
+        query_grams = CompanyNameIndex.name_grams(key_name)
+        query_size = len(query_grams)
+
+        # How many n-grams each name shares with the query
+        planes = CompanyNameIndex.count_bits([self.gram_masks[gram] for gram in query_grams
+                                              if gram in self.gram_masks])
+
+        # Names with more than max_size n-grams can't reach min_score no matter what they
+        # share.  The rest need more shared n-grams the bigger they are.  Sizes that need
+        # the same number are checked together.
+        max_size = int(query_size * (2.0 - min_score) / min_score + 1e-9)
+        sizes_by_min_shared = {}
+
+        for name_size, size_mask in self.size_masks.items():
+            if name_size <= max_size:
+                min_shared = CompanyNameIndex.min_shared_grams(query_size, name_size, min_score)
+                sizes_by_min_shared[min_shared] = sizes_by_min_shared.get(min_shared, 0) | size_mask
+
+        candidates = 0
+
+        for min_shared, size_mask in sizes_by_min_shared.items():
+            candidates = candidates | CompanyNameIndex.at_least(planes, min_shared, size_mask)
+
+        # Everything left scores at least min_score
+        best_ticker, best_score = self.best_match(query_grams, self.mask_names(candidates))
+
+        if best_score < min_score:
+            return (None, 0.0)
+
+        return (best_ticker, best_score)
+
+    def lookup_batch(self, company_names, min_score = NAME_INDEX_MIN_SCORE):
+        # Resolve a whole feed worth of names at once.  News and dividend feeds repeat
+        # the same companies constantly, so each distinct name is only looked up once.
+        resolved = {}
+        results = []
+
+        for company_name in company_names:
+            if company_name not in resolved:
+                resolved[company_name] = self.lookup(company_name, min_score)
+
+            results.append(resolved[company_name])
+
+        return results
+
+
 class NasdaqScraper:
     def __init__(self):
         self.nasdaq_file_object = None
 
+        # Built from the snapshot the first time it's needed, then kept up to date with
+        # each delta this scraper produces
+        self.name_index = None
+
+        # (exchange, page) of every screener page from the last scrape that didn't pair
+        # up into company names and tickers
+        self.inconsistent_pages = []
+
     # This function overwrites whatever was in the nasdaq_file and opens
     # it for new writing
     def open_nasdaq_file(self):
@@ -180,141 +828,167 @@ class NasdaqScraper:
     def close_nasdaq_file(self):
         self.nasdaq_file_object.close()
 
-    def update_nasdaq_file(self):
-        # Open the file that all the stock ticker names will be written to.
-        # Write the result as a CSV with elements of the form: <company name>,<ticker symbol>
-        output_file = open(nasdaq_file, "w")
-
-        for i in range(1, PAGES_IN_NASDAQ_DATABASE):
-            nasdaq_data = requests.get(nasdaq_list_url + "&page=" + str(i))
+    def scrape_exchange(self, list_url, first_page, last_page, exchange):
+        # Stream every (company name, ticker, exchange) listing off of the screener pages
+        # for a single exchange, one page in memory at a time.  Tickers are not validated
+        # here; that is left up to the TickerUniverse so that both exchanges are held to
+        # the same rules.  A page whose cells don't pair up is skipped and recorded in
+        # self.inconsistent_pages rather than guessed at.
+        for page in range(first_page, last_page):
+            nasdaq_data = requests.get(list_url + "&page=" + str(page))
 
             nasdaq_soup = BeautifulSoup(nasdaq_data.text, 'html5lib')
+            nasdaq_data = None
 
-            # Start pulling out the irrelevent data elements
-            filtered_nasdaq = ""
-            filtered_nasdaq = nasdaq_soup.find_all('td', {"class" : None}, style=None)
-
-            temp_filtered_nasdaq = []
-            final_filtered_nasdaq = []
+            # Only one page worth of cells is ever held here
+            page_cells = []
 
             # Starting with 4th first entry in the list, out of every 4 entries in the
             # list, two are useful and two are not (something about country of origin and
-            # IPO year)
-            for i in range(0, len(filtered_nasdaq)):
-                if i > 3 and (i % 4 == 0 or i % 4 == 1):
-                    temp_filtered_nasdaq.append(filtered_nasdaq[i])
+            # IPO year).  The useful ones alternate between company name and ticker.
+            for i, cell in enumerate(nasdaq_soup.find_all('td', {"class" : None}, style=None)):
+                if i <= 3 or i % 4 > 1:
+                    continue
 
-            # Finish filtering the text
-            for i in range(0, len(temp_filtered_nasdaq)):
+                links = cell.find_all('a')
 
-                if len(temp_filtered_nasdaq[i].find_all('a')) == 0:
-                    final_filtered_nasdaq.append(temp_filtered_nasdaq[i].text.strip(" \t\n"))
+                if len(links) == 0:
+                    page_cells.append(cell.text.strip(" \t\n"))
                 else:
-                    final_filtered_nasdaq.append(temp_filtered_nasdaq[i].find_all('a')[0].text.strip(" \t\n"))
+                    page_cells.append(links[0].text.strip(" \t\n"))
 
-            # There are some weird entries sticking around after the initial filtering is done.
-            # Attempt to filter out those extraneous entries.
-            temp_list = []
-            for i in range(0, len(final_filtered_nasdaq)):
-                if i % 2 == 0:
-                    continue
+            # Let the parse tree go before sleeping on the next request
+            nasdaq_soup.decompose()
 
-                if not any(c.islower() for c in final_filtered_nasdaq[i]):
-                    # Tokenize and normalize the company names
-                    company_name = final_filtered_nasdaq[i - 1]
+            if len(page_cells) % 2 != 0:
+                print "[ERROR]: %s page %s not consistent!" % (exchange, page)
+                self.inconsistent_pages.append((exchange, page))
+            else:
+                for i in range(0, len(page_cells), 2):
+                    yield (page_cells[i], page_cells[i + 1], exchange)
 
-                    company_name = NormalizeText.normalize_text(str(company_name))
+            page_cells = None
 
-                    temp_list.append(company_name)
-                    temp_list.append(final_filtered_nasdaq[i])
+            # Wait two seconds in-between making a request
+            time.sleep(2)
 
-            final_filtered_nasdaq = temp_list
+    def build_universe(self):
+        universe = TickerUniverse()
+        self.inconsistent_pages = []
 
-            if len(final_filtered_nasdaq) % 2 != 0:
-                print "[ERROR]: Nasdaq file not consistent!"
-                return
+        for company_name, ticker, exchange in self.scrape_exchange(nasdaq_list_url, 1,
+                PAGES_IN_NASDAQ_DATABASE, "NASDAQ"):
+            universe.add_listing(company_name, ticker, exchange)
 
-            for i in range(0, len(final_filtered_nasdaq)):
-                if i % 2 == 1:
-                    continue
+        for company_name, ticker, exchange in self.scrape_exchange(nyse_list_url, 0,
+                PAGES_IN_NYSE_DATABASE, "NYSE"):
+            universe.add_listing(company_name, ticker, exchange)
 
-                output_file.write("%s,%s,NASDAQ\n" % (final_filtered_nasdaq[i], final_filtered_nasdaq[i + 1]))
+        return universe
 
-            # Wait two seconds in-between making a request
-            time.sleep(2)
-def main(argc, argv):
+    def update_nasdaq_file(self, database=None, force=False):
+        # Rebuild the universe, diff it against the last snapshot and only persist what
+        # actually changed.  The snapshot itself is written as a CSV with elements of the
+        # form: <company name>,<ticker symbol>,<exchange>
+        previous_universe = TickerUniverse.load(nasdaq_file)
+        current_universe = self.build_universe()
 
+        # If nothing came back at all, the screener is most likely down.  Don't wipe out
+        # the previous snapshot because of it.
+        if len(current_universe) == 0:
+            print "[ERROR]: No listings were scraped.  Keeping the previous snapshot."
+            return UniverseDelta()
 
-        for i in range(0, PAGES_IN_NYSE_DATABASE):
-            nasdaq_data = requests.get(nyse_list_url + "&page=" + str(i))
+        # The listings on a skipped page would look like delistings.  Unless told to
+        # take the scrape as it is, nothing on an exchange with a skipped page gets
+        # removed this time around.  Additions and updates still go through.
+        inconsistent_exchanges = sorted(set([exchange for exchange, page in self.inconsistent_pages]))
 
-            nasdaq_soup = BeautifulSoup(nasdaq_data.text, 'html5lib')
+        if len(inconsistent_exchanges) > 0 and force is False:
+            for exchange in inconsistent_exchanges:
+                print "[ERROR]: Some %s screener pages were skipped.  Keeping the %s listings that didn't come back." \
+                    % (exchange, exchange)
 
-            # Start pulling out the irrelevent data elements
-            filtered_nasdaq = ""
-            filtered_nasdaq = nasdaq_soup.find_all('td', {"class" : None}, style=None)
+            current_universe.keep_missing_listings(previous_universe, inconsistent_exchanges)
 
-            temp_filtered_nasdaq = []
-            final_filtered_nasdaq = []
+        delta = current_universe.diff(previous_universe)
 
-            # Starting with 4th first entry in the list, out of every 4 entries in the
-            # list, two are useful and two are not (something about country of origin and
-            # IPO year)
-            for i in range(0, len(filtered_nasdaq)):
-                if i > 3 and (i % 4 == 0 or i % 4 == 1):
-                    temp_filtered_nasdaq.append(filtered_nasdaq[i])
+        # A partial scrape (one exchange down, a few empty pages) looks exactly like a
+        # wave of delistings.  Don't trust large removals unless told to.
+        removed_fractions = delta.removed_fractions(previous_universe)
+        suspect_exchanges = sorted([exchange for exchange, fraction in removed_fractions.items()
+                                    if fraction > MAX_REMOVED_FRACTION])
 
-            # Finish filtering the text
-            for i in range(0, len(temp_filtered_nasdaq)):
+        if len(suspect_exchanges) > 0 and force is False:
+            for exchange in suspect_exchanges:
+                print "[ERROR]: %.1f%% of %s tickers disappeared.  Keeping the previous snapshot." \
+                    % (removed_fractions[exchange] * 100, exchange)
 
-                if len(temp_filtered_nasdaq[i].find_all('a')) == 0:
-                    final_filtered_nasdaq.append(temp_filtered_nasdaq[i].text.strip(" \t\n"))
-                else:
-                    final_filtered_nasdaq.append(temp_filtered_nasdaq[i].find_all('a')[0].text.strip(" \t\n"))
+            return UniverseDelta()
 
-            # There are some weird entries sticking around after the initial filtering is done.
-            # Attempt to filter out those extraneous entries.
-            temp_list = []
-            for i in range(0, len(final_filtered_nasdaq)):
-                if i % 2 == 0:
-                    continue
+        if delta.is_empty():
+            return delta
 
-                if not any(c.islower() for c in final_filtered_nasdaq[i]):
-                    # Tokenize and normalize the company names
-                    company_name = final_filtered_nasdaq[i - 1]
+        # Queue the changes before moving the snapshot forward.  If the snapshot write
+        # doesn't make it, the same changes just get queued again on the next run.
+        delta.queue()
+        current_universe.save(nasdaq_file)
 
-                    company_name = NormalizeText.normalize_text(str(company_name))
+        if database is not None:
+            delta.write_to_database(database)
 
-                    temp_list.append(company_name)
-                    temp_list.append(final_filtered_nasdaq[i])
+        if self.name_index is not None:
+            self.name_index.apply_delta(delta)
 
-            final_filtered_nasdaq = temp_list
+        return delta
 
-            if len(final_filtered_nasdaq) % 2 != 0:
-                print "[ERROR]: Nasdaq file not consistent!"
-                return
+    def get_name_index(self):
+        if self.name_index is None:
+            self.name_index = CompanyNameIndex.from_universe(TickerUniverse.load(nasdaq_file))
 
-            for i in range(0, len(final_filtered_nasdaq)):
-                if i % 2 == 1:
-                    continue
+        return self.name_index
 
-                output_file.write("%s,%s,NYSE\n" % (final_filtered_nasdaq[i], final_filtered_nasdaq[i + 1]))
+    def resolve_company_names(self, company_names):
+        # Map free text company names (from news, dividend feeds, ...) to tickers.  Returns
+        # a (ticker, score) pair for each name; see CompanyNameIndex.lookup.
+        return self.get_name_index().lookup_batch(company_names)
 
-            # Wait two seconds in-between making a request
-            time.sleep(2)
 
-        # Close the output file now that I'm done writing all of the stock results
-        output_file.close()
+def peak_rss_kb():
+    # Peak resident set size of this process so far.  Linux reports ru_maxrss in
+    # kilobytes; OS X reports it in bytes.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        peak_rss = peak_rss / 1024
+
+    return peak_rss
 
 
 def get_nasdaq_file(self):
     pass
 
 
-def update_file():
+def update_file(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], "f", ["force"])
+    except getopt.GetoptError as e:
+        print "[ERROR]: %s" % str(e)
+        print "Usage: %s [-f|--force]" % argv[0]
+        print "  -f, --force  Accept the scrape even if an exchange lost more than %d%% of its tickers" \
+            % int(MAX_REMOVED_FRACTION * 100)
+        print "               or had screener pages that weren't consistent"
+        sys.exit(2)
+
+    force = len(opts) > 0
+
     scraper = NasdaqScraper()
 
-    scraper.update_nasdaq_file()
+    delta = scraper.update_nasdaq_file(force=force)
+
+    print "Added: %s, Removed: %s, Renamed: %s, Updated: %s" % (len(delta.added),
+        len(delta.removed), len(delta.renamed), len(delta.updated))
+    print "Peak RSS: %s KB" % (peak_rss_kb())
 
 
 
@@ -326,7 +1000,7 @@ def update_file():
 # update the file when calling it as a script.  I'll worry about that later.
 # Potentially think about adding options using getopt.
 if __name__ == "__main__":
-    update_file()
+    update_file(sys.argv)
 
 
 